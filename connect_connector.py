@@ -58,19 +58,28 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
         creator=getconn,
         # [START_EXCLUDE]
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
+        pool_size=20,
         # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
+        max_overflow=30,
         # The total number of concurrent connections for your application will be
         # a total of pool_size and max_overflow.
         # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
         # new connection from the pool. After the specified amount of time, an
         # exception will be thrown.
-        pool_timeout=30,  # 30 seconds
+        pool_timeout=10,  # 10 seconds
         # 'pool_recycle' is the maximum number of seconds a connection can persist.
         # Connections that live longer than the specified amount of time will be
         # re-established
         pool_recycle=1800,  # 30 minutes
+        # 'pool_pre_ping' tests a connection when it is checked out and
+        # transparently replaces it if the server has dropped it.
+        pool_pre_ping=True,
+        # 'pool_use_lifo' hands out the most recently returned connection first,
+        # so bursts reuse warm connections and idle overflow ones can time out.
+        pool_use_lifo=True,
+        # 'query_cache_size' is the number of compiled statements SQLAlchemy
+        # keeps per engine, so each statement is only compiled on first use.
+        query_cache_size=1200,
         # [END_EXCLUDE]
     )
     return pool
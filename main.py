@@ -18,8 +18,10 @@ from dotenv import load_dotenv
 import logging
 import os
 
-from flask import Flask, request, url_for
+from flask import Flask, Response, request, url_for
+from flask.json.provider import DefaultJSONProvider
 
+import orjson
 import sqlalchemy
 
 from connect_connector import connect_with_connector
@@ -33,8 +35,79 @@ ERROR_NOT_FOUND = {'Error' : 'No business with this business_id exists'}
 ERROR_REVIEW_NOT_FOUND = {"Error": "No review with this review_id exists"}
 ERROR_BAD_REQUEST = {'Error': 'The request body is missing at least one of the required attributes'}
 ERROR_CONFLICT = {"Error": "You have already submitted a review for this business. You can update your previous review, or delete it and submit a new review"}
+ERROR_BAD_PAGINATION = {'Error': 'limit must be a positive integer, and pages are selected with the after parameter from the next link instead of offset'}
+
+# attributes that must be present in request bodies
+BUSINESS_REQUIRED = ('owner_id', 'name', 'street_address', 'city', 'state', 'zip_code')
+REVIEW_REQUIRED = ('user_id', 'business_id', 'stars')
+
+# MySQL error codes raised when a UNIQUE or FOREIGN KEY constraint is violated
+ER_DUP_ENTRY = 1062
+ER_NO_REFERENCED_ROW_2 = 1452
+
+# largest value of the BIGINT UNSIGNED businesses.id column
+MAX_BUSINESS_ID = 2**64 - 1
+
+# SQL statements are built once at import time and reused by every request
+BUSINESS_COLUMNS = 'id, owner_id, name, street_address, city, state, zip_code'
+REVIEW_COLUMNS = 'id, user_id, business_id, stars, review_text'
+
+SQL_INSERT_BUSINESS = sqlalchemy.text(
+    'INSERT INTO businesses(owner_id, name, street_address, city, state, zip_code) '
+    ' VALUES (:owner_id, :name, :street_address, :city, :state, :zip_code)'
+)
+SQL_GET_BUSINESS = sqlalchemy.text('SELECT ' + BUSINESS_COLUMNS + ' FROM businesses WHERE id=:id')
+SQL_UPDATE_BUSINESS = sqlalchemy.text(
+    'UPDATE businesses '
+    'SET owner_id = :owner_id, name = :name, street_address = :street_address, city = :city, state = :state, zip_code = :zip_code '
+    'WHERE id = :id'
+)
+SQL_DELETE_BUSINESS = sqlalchemy.text('DELETE FROM businesses WHERE id=:id')
+# list queries page by primary key (keyset pagination) instead of OFFSET
+SQL_LIST_BUSINESSES = sqlalchemy.text(
+    'SELECT ' + BUSINESS_COLUMNS + ' FROM businesses WHERE id > :after ORDER BY id LIMIT :limit'
+)
+SQL_LIST_BUSINESSES_BY_OWNER = sqlalchemy.text(
+    'SELECT ' + BUSINESS_COLUMNS + ' FROM businesses WHERE owner_id = :owner_id'
+)
+
+# Unknown businesses and duplicate reviews are rejected by the foreign key and
+# the unique (user_id, business_id) constraint
+SQL_INSERT_REVIEW = sqlalchemy.text(
+    'INSERT INTO reviews (user_id, business_id, stars, review_text) '
+    'VALUES (:user_id, :business_id, :stars, :review_text)'
+)
+SQL_GET_REVIEW = sqlalchemy.text('SELECT ' + REVIEW_COLUMNS + ' FROM reviews WHERE id=:id')
+# review_text is only overwritten (possibly with NULL) when :set_review_text is true
+SQL_UPDATE_REVIEW = sqlalchemy.text(
+    'UPDATE reviews SET stars = :stars, '
+    'review_text = IF(:set_review_text, :review_text, review_text) '
+    'WHERE id = :id'
+)
+SQL_DELETE_REVIEW = sqlalchemy.text('DELETE FROM reviews WHERE id=:id')
+SQL_LIST_REVIEWS_BY_USER = sqlalchemy.text(
+    'SELECT ' + REVIEW_COLUMNS + ' FROM reviews WHERE user_id = :user_id'
+)
+SQL_LIST_REVIEWS = sqlalchemy.text(
+    'SELECT ' + REVIEW_COLUMNS + ' FROM reviews WHERE id > :after ORDER BY id LIMIT :limit'
+)
+
+# Encodes responses with orjson while keeping Flask's sorted keys and its
+# fallback for types such as Decimal. Dates and datetimes are passed through
+# to that fallback so they keep Flask's HTTP date format.
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs) -> str:
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 logger = logging.getLogger()
 
@@ -55,44 +128,180 @@ def init_db():
     global db
     db = init_connection_pool()
 
-# create 'lodgings' table in database if it does not already exist
-def create_table(db: sqlalchemy.engine.base.Engine) -> None:
-    with db.connect() as conn:
-        conn.execute(
-            sqlalchemy.text("""
-                CREATE TABLE IF NOT EXISTS businesses (
-                    id SERIAL PRIMARY KEY,
-                    owner_id INT NOT NULL,
-                    name VARCHAR(50) NOT NULL,
-                    street_address VARCHAR(100) NOT NULL,
-                    city VARCHAR(50) NOT NULL,
-                    state VARCHAR(2) NOT NULL,
-                    zip_code VARCHAR(5) NOT NULL
-                );
-            """)
+
+# Returns the DATA_TYPE of a column in the current database, or None
+def column_type(conn: sqlalchemy.engine.base.Connection, table: str, column: str) -> str | None:
+    return conn.execute(
+        sqlalchemy.text(
+            'SELECT DATA_TYPE FROM information_schema.COLUMNS '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND COLUMN_NAME = :column'
+        ),
+        {'table': table, 'column': column}
+    ).scalar()
+
+
+# Returns True if the named constraint exists on a table in the current database
+def constraint_exists(conn: sqlalchemy.engine.base.Connection, table: str, name: str) -> bool:
+    return conn.execute(
+        sqlalchemy.text(
+            'SELECT 1 FROM information_schema.TABLE_CONSTRAINTS '
+            'WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = :table AND CONSTRAINT_NAME = :name'
+        ),
+        {'table': table, 'name': name}
+    ).scalar() is not None
+
+
+# Upgrades a businesses table created before zip_code became an INTEGER
+def migrate_businesses_table(conn: sqlalchemy.engine.base.Connection) -> None:
+    if column_type(conn, 'businesses', 'zip_code') != 'varchar':
+        return
+
+    # strict mode aborts the ALTER on any zip code that is not a number
+    bad_ids = conn.execute(
+        sqlalchemy.text(
+            "SELECT id FROM businesses WHERE zip_code NOT REGEXP '^[0-9]{1,5}$' ORDER BY id"
+        )
+    ).scalars().all()
+    if bad_ids:
+        logger.error('businesses with non-numeric zip_code: %s', bad_ids)
+        raise RuntimeError(
+            f'Cannot convert businesses.zip_code to INTEGER: {len(bad_ids)} businesses '
+            f'have a zip code that is not 1-5 digits (ids {bad_ids}). Fix them and restart.'
         )
 
-        conn.execute(
-            sqlalchemy.text("""
-                CREATE TABLE IF NOT EXISTS reviews (
-                    id SERIAL PRIMARY KEY,
-                    user_id INT NOT NULL,
-                    business_id INT NOT NULL REFERENCES businesses(id),
-                    stars INT CHECK (stars BETWEEN 0 and 5),
-                    review_text VARCHAR(1000) DEFAULT NULL
-                );
-            """)
+    conn.execute(
+        sqlalchemy.text("""
+            ALTER TABLE businesses
+                MODIFY zip_code INTEGER NOT NULL,
+                ADD CONSTRAINT chk_businesses_zip_code CHECK (zip_code BETWEEN 0 AND 99999),
+                ADD INDEX idx_businesses_owner (owner_id);
+        """)
+    )
+
+
+# Upgrades a reviews table created before the database enforced one review per
+# user and business and the business foreign key. post_review and
+# delete_business rely on these constraints.
+def migrate_reviews_table(conn: sqlalchemy.engine.base.Connection) -> None:
+    if constraint_exists(conn, 'reviews', 'fk_reviews_business'):
+        return
+
+    # rows the new constraints would reject are reported, never deleted:
+    # reviews of deleted businesses, and every review after the first one
+    # per user and business
+    orphan_ids = conn.execute(
+        sqlalchemy.text("""
+            SELECT r.id FROM reviews r
+            LEFT JOIN businesses b ON b.id = r.business_id
+            WHERE b.id IS NULL
+            ORDER BY r.id;
+        """)
+    ).scalars().all()
+    duplicate_ids = conn.execute(
+        sqlalchemy.text("""
+            SELECT DISTINCT r1.id FROM reviews r1
+            JOIN reviews r2 ON r1.user_id = r2.user_id
+                AND r1.business_id = r2.business_id
+                AND r1.id > r2.id
+            ORDER BY r1.id;
+        """)
+    ).scalars().all()
+    if orphan_ids or duplicate_ids:
+        logger.error('reviews of missing businesses: %s', orphan_ids)
+        logger.error('duplicate reviews of the same business by the same user: %s', duplicate_ids)
+        raise RuntimeError(
+            f'Cannot add the reviews constraints: {len(orphan_ids)} reviews reference '
+            f'missing businesses and {len(duplicate_ids)} reviews duplicate an earlier '
+            'review by the same user. Resolve the logged review ids and run init-db again.'
         )
 
+    conn.execute(
+        sqlalchemy.text("""
+            ALTER TABLE reviews
+                MODIFY business_id BIGINT UNSIGNED NOT NULL,
+                ADD CONSTRAINT uq_reviews_user_business UNIQUE (user_id, business_id),
+                ADD INDEX idx_reviews_business (business_id),
+                ADD CONSTRAINT fk_reviews_business FOREIGN KEY (business_id)
+                    REFERENCES businesses(id) ON DELETE CASCADE;
+        """)
+    )
+
+
+# create 'lodgings' table in database if it does not already exist
+# and upgrade tables created by earlier versions of the schema
+def create_table(db: sqlalchemy.engine.base.Engine) -> None:
+    with db.begin() as conn:
+        # several instances may start at once, only one of them may migrate the schema
+        if conn.execute(sqlalchemy.text("SELECT GET_LOCK('reviewmate_schema', 60)")).scalar() != 1:
+            raise RuntimeError('Timed out waiting for another instance to finish the schema setup')
+        try:
+            create_missing_tables(conn)
+            migrate_businesses_table(conn)
+            migrate_reviews_table(conn)
+        finally:
+            conn.execute(sqlalchemy.text("SELECT RELEASE_LOCK('reviewmate_schema')"))
+
+
+# Runs CREATE TABLE IF NOT EXISTS for the businesses and reviews tables
+def create_missing_tables(conn: sqlalchemy.engine.base.Connection) -> None:
+    conn.execute(
+        sqlalchemy.text("""
+            CREATE TABLE IF NOT EXISTS businesses (
+                id SERIAL PRIMARY KEY,
+                owner_id INT NOT NULL,
+                name VARCHAR(50) NOT NULL,
+                street_address VARCHAR(100) NOT NULL,
+                city VARCHAR(50) NOT NULL,
+                state VARCHAR(2) NOT NULL,
+                zip_code INTEGER NOT NULL,
+                CONSTRAINT chk_businesses_zip_code CHECK (zip_code BETWEEN 0 AND 99999),
+                INDEX idx_businesses_owner (owner_id)
+            );
+        """)
+    )
+
+    conn.execute(
+        sqlalchemy.text("""
+            CREATE TABLE IF NOT EXISTS reviews (
+                id SERIAL PRIMARY KEY,
+                user_id INT NOT NULL,
+                business_id BIGINT UNSIGNED NOT NULL,
+                stars INT CHECK (stars BETWEEN 0 and 5),
+                review_text VARCHAR(1000) DEFAULT NULL,
+                CONSTRAINT uq_reviews_user_business UNIQUE (user_id, business_id),
+                INDEX idx_reviews_business (business_id),
+                CONSTRAINT fk_reviews_business FOREIGN KEY (business_id)
+                    REFERENCES businesses(id) ON DELETE CASCADE
+            );
+        """)
+    )
+
+
+# Initializes the database and returns the app. Gunicorn calls this in every
+# worker (main:create_app()) so each process opens its own connection pool.
+# The schema is set up beforehand by the init-db command, not by the workers.
+def create_app() -> Flask:
+    init_db()
+    return app
+
+
+# Creates and upgrades the tables, run once before starting the server:
+#   flask --app main init-db
+@app.cli.command('init-db')
+def init_db_command() -> None:
+    init_db()
+    create_table(db)
+
 
-        conn.commit()
 
 
+# built once, the root route is hit constantly by health checks
+INDEX_RESPONSE = Response('Please navigate to /businesses to use this API', mimetype='text/plain')
 
 
 @app.route('/')
 def index():
-    return 'Please navigate to /businesses to use this API'
+    return INDEX_RESPONSE
 
 
 
@@ -102,30 +311,27 @@ def index():
 def post_businesses():
     content = request.get_json()
 
+    # a JSON body that is not an object (e.g. null) has no attributes at all
+    if not isinstance(content, dict):
+        return ERROR_BAD_REQUEST, 400
+    missing_fields = [field for field in BUSINESS_REQUIRED if field not in content]
+    if missing_fields:
+        return ERROR_BAD_REQUEST, 400
+
     try:
-        # Using a with statement ensures that the connection is always released
-        # back into the pool at the end of statement (even if an error occurs)
-        with db.connect() as conn:
+        # db.begin() commits when the block exits normally and rolls back if
+        # an error occurs, then releases the connection back into the pool
+        with db.begin() as conn:
             # Preparing a statement before hand can help protect against injections.
-            stmt = sqlalchemy.text(
-                'INSERT INTO businesses(owner_id, name, street_address, city, state, zip_code) '
-                ' VALUES (:owner_id, :name, :street_address, :city, :state, :zip_code)'
-            )
-            # connection.execute() automatically starts a transaction
-            conn.execute(stmt, parameters={'owner_id': content['owner_id'],
+            result = conn.execute(SQL_INSERT_BUSINESS, parameters={'owner_id': content['owner_id'],
                                         'name': content['name'], 
                                         'street_address': content['street_address'], 
                                         'city': content['city'],
                                         'state': content['state'],
                                         'zip_code': content['zip_code']})
-            # The function last_insert_id() returns the most recent value
-            # generated for an `AUTO_INCREMENT` column when the INSERT 
-            # statement is executed
-            stmt2 = sqlalchemy.text('SELECT last_insert_id()')
-            # scalar() returns the first column of the first row or None if there are no rows
-            business_id = conn.execute(stmt2).scalar()
-            # Remember to commit the transaction
-            conn.commit()
+            # lastrowid is the `AUTO_INCREMENT` value generated by the INSERT,
+            # reported back in the same response so no extra query is needed
+            business_id = result.lastrowid
         
         #construct url
         base_url = request.base_url
@@ -140,9 +346,6 @@ def post_businesses():
                 'zip_code': content['zip_code'],
                 'self': complete_url}, 201)
     
-    except KeyError as e:
-        return (ERROR_BAD_REQUEST, 400)
-    
     except Exception as e:
         logger.exception(e)
         return ({'Error': 'Unable to create business'}, 500)
@@ -152,18 +355,13 @@ def post_businesses():
 @app.route('/' + BUSINESSES + '/<int:id>', methods=['GET'])
 def get_business(id):
     with db.connect() as conn:
-        stmt = sqlalchemy.text(
-                'SELECT * FROM businesses WHERE id=:id'
-            )
-        # one_or_none returns at most one result or raise an exception.
-        # returns None if the result has no rows.
-        row = conn.execute(stmt, parameters={'id': id}).one_or_none()
+        # id is the primary key, so first() returns the only row or None
+        # without looking for a second one
+        row = conn.execute(SQL_GET_BUSINESS, parameters={'id': id}).mappings().first()
         if row is None:
             return ERROR_NOT_FOUND, 404
         else:
-            business = row._asdict()
-
-            business['zip_code'] = int(business['zip_code'])
+            business = dict(row)
 
             root_url = request.url_root
             complete_url = f"{root_url}businesses/{id}"
@@ -178,21 +376,19 @@ def get_business(id):
 def put_business(id):
 
     try:
-        with db.connect() as conn:
-            stmt = sqlalchemy.text(
-                    'SELECT * FROM businesses WHERE id=:id'
-                )
-            row = conn.execute(stmt, parameters={'id': id}).one_or_none()
+        with db.begin() as conn:
+            row = conn.execute(SQL_GET_BUSINESS, parameters={'id': id}).one_or_none()
             if row is None:
                 return ERROR_NOT_FOUND, 404
             else:
                 content = request.get_json()
-                stmt = sqlalchemy.text(
-                    'UPDATE businesses '
-                    'SET owner_id = :owner_id, name = :name, street_address = :street_address, city = :city, state = :state, zip_code = :zip_code '
-                    'WHERE id = :id'
-                )
-                conn.execute(stmt, parameters={'owner_id': content['owner_id'],
+                if not isinstance(content, dict):
+                    return ERROR_BAD_REQUEST, 400
+                missing_fields = [field for field in BUSINESS_REQUIRED if field not in content]
+                if missing_fields:
+                    return ERROR_BAD_REQUEST, 400
+
+                conn.execute(SQL_UPDATE_BUSINESS, parameters={'owner_id': content['owner_id'],
                                             'name': content['name'], 
                                             'street_address': content['street_address'], 
                                             'city': content['city'],
@@ -200,7 +396,6 @@ def put_business(id):
                                             'zip_code': content['zip_code'],
                                             'id': id})
                                             
-                conn.commit()
                 root_url = request.url_root
                 complete_url = f"{root_url}businesses/{id}"
 
@@ -212,9 +407,6 @@ def put_business(id):
                 'state': content['state'],
                 'zip_code': content['zip_code'],
                 'self': complete_url}
-            
-    except KeyError as e:
-        return (ERROR_BAD_REQUEST, 400)
     
     except Exception as e:
         logger.exception(e)
@@ -227,19 +419,9 @@ def put_business(id):
 # delete a business
 @app.route('/' + BUSINESSES + '/<int:id>', methods=['DELETE'])
 def delete_business(id):
-    with db.connect() as conn:
-
-        delete_review_stmt = sqlalchemy.text(
-                'DELETE FROM reviews WHERE business_id=:id'
-            )
-        conn.execute(delete_review_stmt, {'id': id})
-
-        stmt = sqlalchemy.text(
-                'DELETE FROM businesses WHERE id=:id'
-            )
-
-        result = conn.execute(stmt, parameters={'id': id})
-        conn.commit()
+    with db.begin() as conn:
+        # the business's reviews are removed by ON DELETE CASCADE
+        result = conn.execute(SQL_DELETE_BUSINESS, parameters={'id': id})
         
         if result.rowcount == 1:
             return ('', 204)
@@ -254,32 +436,26 @@ def delete_business(id):
 @app.route('/' + BUSINESSES, methods=['GET'])
 def get_businesses():
     with db.connect() as conn:
-        # pagination - create offset and limit
-        offset = request.args.get('offset', default=0, type=int)
+        # pagination - resume after the last id of the previous page
+        after = request.args.get('after', default=0, type=int)
         limit = request.args.get('limit', default=3, type=int)
+        if limit < 1 or 'offset' in request.args:
+            return ERROR_BAD_PAGINATION, 400
 
+        rows = conn.execute(SQL_LIST_BUSINESSES, {'limit': limit + 1, 'after': after}).mappings().all()
         
-        stmt = sqlalchemy.text(
-            'SELECT * FROM businesses LIMIT :limit OFFSET :offset'
-        )
-        rows = conn.execute(stmt, {'limit': limit + 1, 'offset': offset}).fetchall()
-        
+        bus_prefix = request.url_root + 'businesses/'
         businesses = []
         for row in rows[:limit]:  # Only return up to 'limit' businesses
-            business = row._asdict()
-            business['zip_code'] = int(business['zip_code'])
-            
-            
-            root_url = request.url_root
-            business['self'] = f"{root_url}businesses/{business['id']}"
-            
+            business = dict(row)
+            business['self'] = bus_prefix + str(business['id'])
             businesses.append(business)
 
         
         response_data = {'entries': businesses}
         if len(rows) > limit:
-            next_offset = offset + limit
-            next_url = f"{request.base_url}?offset={next_offset}&limit={limit}"
+            next_after = rows[limit - 1]['id']
+            next_url = f"{request.base_url}?after={next_after}&limit={limit}"
             response_data['next'] = next_url
 
         return response_data, 200
@@ -292,20 +468,13 @@ def get_businesses():
 @app.route('/owners/<int:id>/' + BUSINESSES, methods=['GET'])
 def get_bussiness_by_owner(id):
     with db.connect() as conn:
-        stmt = sqlalchemy.text(
-                'SELECT * FROM businesses WHERE owner_id = :owner_id'
-            )
-        
-        result = conn.execute(stmt, parameters={'owner_id': id})
-        conn.commit()
+        result = conn.execute(SQL_LIST_BUSINESSES_BY_OWNER, parameters={'owner_id': id})
 
+        bus_prefix = request.url_root + 'businesses/'
         businesses = []
-        
-
-        for row in result.fetchall():
-            business = row._asdict()
-            
-            business['self'] = request.url_root + f"businesses/{business['id']}"
+        for row in result.mappings():
+            business = dict(row)
+            business['self'] = bus_prefix + str(business['id'])
             businesses.append(business)
 
         return businesses
@@ -319,59 +488,39 @@ def post_review():
     content = request.get_json()
 
 
-    required_fields = ['user_id', 'business_id', 'stars']
-    missing_fields = [field for field in required_fields if field not in content]
-
+    if not isinstance(content, dict):
+        return ERROR_BAD_REQUEST, 400
+    missing_fields = [field for field in REVIEW_REQUIRED if field not in content]
     if missing_fields:
         return ERROR_BAD_REQUEST, 400
+
+    # anything but an integer in the id column's range cannot match a business,
+    # and the INSERT would fail with a data error instead of a foreign key error
+    business_id = content['business_id']
+    if (not isinstance(business_id, int) or isinstance(business_id, bool)
+            or not 0 <= business_id <= MAX_BUSINESS_ID):
+        return ERROR_NOT_FOUND, 404
     
 
     try:
         
-        with db.connect() as conn:
-
-            business_check = sqlalchemy.text(
-                'SELECT 1 FROM businesses ' 
-                'WHERE id = :business_id '
-            )
-            if not conn.execute(business_check, {'business_id': content['business_id']}).scalar():
-                return ERROR_NOT_FOUND, 404
-
-
-            # check if review exists
-            check_stmt = sqlalchemy.text("""
-                SELECT 1 FROM reviews 
-                WHERE user_id = :user_id AND business_id = :business_id;
-            """)
-            existing_review = conn.execute(check_stmt, {
-                'user_id': content['user_id'],
-                'business_id': content['business_id']
-            }).fetchone()
-            
-            if existing_review:
-                return ERROR_CONFLICT, 409
-
-
-
-            
-            stmt = sqlalchemy.text("""
-                INSERT INTO reviews (user_id, business_id, stars, review_text)
-                VALUES (:user_id, :business_id, :stars, :review_text);
-            """)
-            
-            
-            conn.execute(stmt, parameters={'user_id': content['user_id'],
-                                        'business_id': content['business_id'], 
-                                        'stars': content['stars'], 
-                                        'review_text': content.get('review_text', '')})
-            
+        with db.begin() as conn:
+            try:
+                result = conn.execute(SQL_INSERT_REVIEW, parameters={'user_id': content['user_id'],
+                                            'business_id': content['business_id'], 
+                                            'stars': content['stars'], 
+                                            'review_text': content.get('review_text', '')})
+            except sqlalchemy.exc.IntegrityError as e:
+                # the business does not exist
+                if e.orig.args[0] == ER_NO_REFERENCED_ROW_2:
+                    return ERROR_NOT_FOUND, 404
+                # the user already reviewed this business
+                if e.orig.args[0] == ER_DUP_ENTRY:
+                    return ERROR_CONFLICT, 409
+                raise
+
+            review_id = result.lastrowid
 
-
-            stmt2 = sqlalchemy.text('SELECT last_insert_id()')
-            # scalar() returns the first column of the first row or None if there are no rows
-            review_id = conn.execute(stmt2).scalar()
-
-            conn.commit()
         
         
         #construct url for review
@@ -388,9 +537,6 @@ def post_review():
                 'review_text': content.get('review_text', ''),
                 'self': complete_url}, 201)
     
-    except KeyError as e:
-        return ERROR_BAD_REQUEST, 400
-    
     except Exception as e:
         logger.exception(e)
         print(f"Error occurred: {e}")
@@ -401,28 +547,20 @@ def post_review():
 @app.route('/' + REVIEWS + '/<int:id>', methods=['GET'])
 def get_review(id):
     with db.connect() as conn:
-        stmt = sqlalchemy.text(
-                'SELECT * FROM reviews WHERE id=:id'
-            )
-        
-        row = conn.execute(stmt, parameters={'id': id}).one_or_none()
+        row = conn.execute(SQL_GET_REVIEW, parameters={'id': id}).mappings().first()
         if row is None:
             return ERROR_REVIEW_NOT_FOUND, 404
-        
-        review = row._asdict()
 
-        # review['zip_code'] = int(review['zip_code'])
-
-        business_url = f"{request.host_url}businesses/{review['business_id']}"
+        business_url = f"{request.host_url}businesses/{row['business_id']}"
         review_url = f"{request.host_url}reviews/{id}"
 
         # updated return
         review_response = {
-            "id": review['id'],
-            "user_id": review['user_id'],
+            "id": row['id'],
+            "user_id": row['user_id'],
             "business": business_url,
-            "stars": review['stars'],
-            "review_text": review['review_text'],
+            "stars": row['stars'],
+            "review_text": row['review_text'],
             "self": review_url
         }
     
@@ -440,56 +578,33 @@ def put_review(id):
 
     content = request.get_json()
 
-    if 'stars' not in content:
+    if not isinstance(content, dict) or 'stars' not in content:
         return ERROR_BAD_REQUEST, 400
 
-    
-    update_parts = []
-    update_params = {}
-    if 'stars' in content:
-        update_parts.append('stars = :stars')
-        update_params['stars'] = content['stars']
-    if 'review_text' in content:
-        update_parts.append('review_text = :review_text')
-        update_params['review_text'] = content['review_text']
-
-    
-    if not update_parts:
-        return {'Error': 'No valid fields provided to update'}, 400
-
-    update_params['id'] = id
-        
-    with db.connect() as conn:
-        # Check if the review exists
-        exists_check = sqlalchemy.text('SELECT 1 FROM reviews WHERE id = :id')
-        exists = conn.execute(exists_check, {'id': id}).scalar()
-        if not exists:
-            return ERROR_REVIEW_NOT_FOUND, 404
-
+    with db.begin() as conn:
         # Perform the update
-        update_stmt = sqlalchemy.text('UPDATE reviews SET ' + ', '.join(update_parts) + ' WHERE id = :id')
-        conn.execute(update_stmt, update_params)
-        conn.commit()
+        conn.execute(SQL_UPDATE_REVIEW, {'id': id,
+                                         'stars': content['stars'],
+                                         'set_review_text': 'review_text' in content,
+                                         'review_text': content.get('review_text')})
 
-        # Retrieve the updated review to return
-        review_stmt = sqlalchemy.text('SELECT * FROM reviews WHERE id = :id')
-        row = conn.execute(review_stmt, {'id': id}).one_or_none()
+        # Retrieve the updated review to return. A missing row also means
+        # the update matched nothing.
+        row = conn.execute(SQL_GET_REVIEW, {'id': id}).mappings().first()
 
         if row is None:
             return ERROR_REVIEW_NOT_FOUND, 404
-        else:
-            review = row._asdict()
 
-        business_url = f"{request.host_url}businesses/{review['business_id']}"
+        business_url = f"{request.host_url}businesses/{row['business_id']}"
         review_url = f"{request.host_url}reviews/{id}"
 
         
         review_response = {
-            "id": review['id'],
-            "user_id": review['user_id'],
+            "id": row['id'],
+            "user_id": row['user_id'],
             "business": business_url,
-            "stars": review['stars'],
-            "review_text": review.get('review_text', ''),
+            "stars": row['stars'],
+            "review_text": row['review_text'],
             "self": review_url
         }
         
@@ -503,14 +618,8 @@ def put_review(id):
 # delete a review
 @app.route('/' + REVIEWS + '/<int:id>', methods=['DELETE'])
 def delete_review(id):
-    with db.connect() as conn:
-        
-        stmt = sqlalchemy.text(
-                'DELETE FROM reviews WHERE id=:id'
-            )
-
-        result = conn.execute(stmt, parameters={'id': id})
-        conn.commit()
+    with db.begin() as conn:
+        result = conn.execute(SQL_DELETE_REVIEW, parameters={'id': id})
         
         if result.rowcount == 1:
             return ('', 204)
@@ -522,31 +631,17 @@ def delete_review(id):
 @app.route('/users/<int:id>/' + REVIEWS, methods=['GET'])
 def get_review_by_user(id):
     with db.connect() as conn:
-        stmt = sqlalchemy.text(
-                'SELECT * FROM reviews WHERE user_id = :user_id'
-            )
-        
-        result = conn.execute(stmt, parameters={'user_id': id})
-        conn.commit()
-
-        reviews = []
-        
-
-        for row in result.fetchall():
-            review = row._asdict()
-            
-            review['self'] = request.url_root + f"reviews/{review['id']}"
-            business_url = request.url_root + f"businesses/{review['business_id']}"
-
-            updated_review = {
-                "id": review['id'],
-                "user_id": review['user_id'],
-                "business": business_url,
-                "stars": review['stars'],
-                "review_text": review['review_text'],
-                "self": review['self']
-            }
-            reviews.append(updated_review)
+        root_url = request.url_root
+        bus_prefix = root_url + 'businesses/'
+        rev_prefix = root_url + 'reviews/'
+        reviews = [{
+            "id": row['id'],
+            "user_id": row['user_id'],
+            "business": bus_prefix + str(row['business_id']),
+            "stars": row['stars'],
+            "review_text": row['review_text'],
+            "self": rev_prefix + str(row['id'])
+        } for row in conn.execute(SQL_LIST_REVIEWS_BY_USER, parameters={'user_id': id}).mappings()]
 
         return reviews
 
@@ -559,32 +654,26 @@ def get_review_by_user(id):
 @app.route('/' + REVIEWS, methods=['GET'])
 def get_reviews():
     with db.connect() as conn:
-        # pagination - create offset and limit
-        offset = request.args.get('offset', default=0, type=int)
+        # pagination - resume after the last id of the previous page
+        after = request.args.get('after', default=0, type=int)
         limit = request.args.get('limit', default=3, type=int)
+        if limit < 1 or 'offset' in request.args:
+            return ERROR_BAD_PAGINATION, 400
 
+        rows = conn.execute(SQL_LIST_REVIEWS, {'limit': limit + 1, 'after': after}).mappings().all()
         
-        stmt = sqlalchemy.text(
-            'SELECT * FROM reviews LIMIT :limit OFFSET :offset'
-        )
-        rows = conn.execute(stmt, {'limit': limit + 1, 'offset': offset}).fetchall()
-        
+        rev_prefix = request.url_root + 'reviews/'
         reviews = []
         for row in rows[:limit]:  
-            review = row._asdict()
-            # review['zip_code'] = int(business['zip_code'])
-            
-            
-            root_url = request.url_root
-            review['self'] = f"{root_url}reviews/{review['id']}"
-            
+            review = dict(row)
+            review['self'] = rev_prefix + str(review['id'])
             reviews.append(review)
 
         
         response_data = {'entries': reviews}
         if len(rows) > limit:
-            next_offset = offset + limit
-            next_url = f"{request.base_url}?offset={next_offset}&limit={limit}"
+            next_after = rows[limit - 1]['id']
+            next_url = f"{request.base_url}?after={next_after}&limit={limit}"
             response_data['next'] = next_url
 
         return response_data, 200
@@ -598,7 +687,8 @@ def get_reviews():
 
 
 
+# local development only, deployments run under gunicorn (see Dockerfile)
 if __name__ == '__main__':
-    init_db()
+    create_app()
     create_table(db)
     app.run(host='0.0.0.0', port=8080, debug=True)